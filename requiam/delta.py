@@ -1,11 +1,137 @@
-import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice, zip_longest
 import json
 from logging import Logger
+from math import ceil
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import time
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 from redata.commons.logger import log_stdout
+from urllib3.util.retry import Retry
+
+# Maximum number of batches sent concurrently when there is no batch delay
+MAX_WORKERS = 8
+
+# HTTP status codes indicating Grouper is throttling requests
+THROTTLE_CODES = (429, 503)
+
+# Number of successful batches before the in-flight limit grows by one
+GROW_EVERY = 4
+
+# Number of times a throttled batch is resent, and the base backoff in
+# seconds between attempts when Grouper does not send Retry-After
+MAX_THROTTLE_RETRIES = 5
+THROTTLE_BACKOFF = 0.5
+
+# HTTP method, request key, result key, and past tense for each batch action
+BATCH_ACTIONS = {
+    'drop': ('post', 'WsRestDeleteMemberRequest', 'WsDeleteMemberResults', 'dropped'),
+    'add': ('put', 'WsRestAddMemberRequest', 'WsAddMemberResults', 'added'),
+}
+
+# Pre-encoded Grouper add/delete member request body. The member
+# request key and the subject lookups are filled in for each batch
+PAYLOAD_TEMPLATE = '{"%s":{"replaceAllExisting":"F","subjectLookups":[%s]}}'
+SUBJECT_TEMPLATE = '{"subjectId":%s}'
+
+
+def batch_payload(request_key: str, batch: List[str]) -> bytes:
+    """
+    Encode a Grouper add/delete member request body for a batch
+
+    This fills in ``PAYLOAD_TEMPLATE`` directly rather than building a
+    ``dict`` for every member and serializing the whole payload. Each
+    member ID is still encoded with ``json.dumps``
+
+    :param request_key: Either 'WsRestDeleteMemberRequest' or
+           'WsRestAddMemberRequest'
+    :param batch: Member IDs to drop or add
+
+    :return: JSON-encoded request body
+    """
+    subjects = ','.join([SUBJECT_TEMPLATE % json.dumps(entry)
+                         for entry in batch])
+    return (PAYLOAD_TEMPLATE % (request_key, subjects)).encode()
+
+
+class InflightLimit:
+    """
+    Bound the number of batches in flight at once using additive increase,
+    multiplicative decrease (AIMD): the limit is halved when Grouper
+    throttles a batch and raised by one after every ``grow_every``
+    successful batches, up to ``max_inflight``.
+
+    Batches throttled together count as one congestion event: entering
+    the limit returns the current epoch, and a throttle only halves the
+    limit if its batch was sent after the last decrease
+
+    Usage:
+
+    .. highlight:: python
+    .. code-block:: python
+
+       limit = InflightLimit(8)
+       with limit as epoch:
+           rsp = session.post(url)
+       limit.record(rsp.status_code, epoch)
+
+    :param max_inflight: Maximum, and starting, number of batches in flight
+    :param grow_every: Number of successful batches before raising the limit
+
+    :ivar max_inflight: Maximum number of batches in flight
+    :ivar grow_every: Number of successful batches before raising the limit
+    :ivar limit: Current number of batches allowed in flight
+    """
+
+    def __init__(self, max_inflight: int, grow_every: int = GROW_EVERY) -> None:
+        self.max_inflight: int = max_inflight
+        self.grow_every: int = grow_every
+        self.limit: int = max_inflight
+
+        self._inflight = 0
+        self._n_success = 0
+        self._epoch = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self) -> int:
+        with self._cond:
+            self._cond.wait_for(lambda: self._inflight < self.limit)
+            self._inflight += 1
+            return self._epoch
+
+    def __exit__(self, *exc_info: Any) -> None:
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    def record(self, status_code: int, epoch: int) -> bool:
+        """
+        Update the limit from a batch response
+
+        :param status_code: HTTP status code of the batch response
+        :param epoch: Epoch returned when the batch entered the limit
+
+        :return: ``True`` if the batch was throttled
+        """
+        with self._cond:
+            if status_code in THROTTLE_CODES:
+                # Only the first throttle since the last decrease counts
+                if epoch == self._epoch:
+                    self.limit = max(1, self.limit // 2)
+                    self._epoch += 1
+                self._n_success = 0
+                return True
+
+            self._n_success += 1
+            if self._n_success >= self.grow_every and \
+                    self.limit < self.max_inflight:
+                self.limit += 1
+                self._n_success = 0
+                self._cond.notify_all()
+            return False
 
 
 class Delta:
@@ -20,11 +146,14 @@ class Delta:
     Usage:
        ``from requiam import delta``
 
-    :param ldap_members: Set of LDAP member ID
+    :param ldap_members: Set of LDAP member ID. Other iterables are
+           converted to a ``frozenset``
     :param grouper_query_dict: Result from ``Grouper``
     :param batch_size: Number of records to synchronization for each "batch"
     :param batch_timeout: Timeout in seconds for each batch
-    :param batch_delay: Delay between batches in seconds
+    :param batch_delay: Delay in seconds between each pair of a drop and an add
+           batch, which are sent back-to-back. With no delay, batches are
+           sent concurrently
     :param sync_max: Maximum total adds and drops for synchronization
     :param log: Logger object
 
@@ -33,12 +162,18 @@ class Delta:
     :ivar grouper_members: Set of Grouper member IDs
     :ivar batch_size: Number of records to synchronization for each "batch"
     :ivar batch_timeout: Timeout in seconds for each batch
-    :ivar batch_delay: Delay between batches in seconds
+    :ivar batch_delay: Delay in seconds between each pair of a drop and an add
+           batch, which are sent back-to-back. With no delay, batches are
+           sent concurrently
     :ivar sync_max: Maximum total adds and drops for synchronization
     :ivar log: Logger object
     :ivar adds: Set of members to add to Grouper group
     :ivar drops: Set of members to drop from Grouper group
     :ivar common: Set of members in common with EDS/LDAP and Grouper
+    :ivar session: ``requests.Session`` shared by all batches so the Grouper
+          HTTPS connection is reused. Transient failures are retried with
+          backoff. Only open during :meth:`synchronize`
+    :ivar members_url: Grouper members endpoint for the group
     """
 
     def __init__(self, ldap_members: set, grouper_query_dict: Dict[str, Any],
@@ -52,21 +187,56 @@ class Delta:
 
         self.log.debug('entered')
 
+        # Normalize once so set operations never implicitly rehash a list
+        grouper_members = grouper_query_dict['members']
+        if not isinstance(ldap_members, (set, frozenset)):
+            ldap_members = frozenset(ldap_members)
+        if not isinstance(grouper_members, (set, frozenset)):
+            grouper_members = frozenset(grouper_members)
+
         self.ldap_members: set = ldap_members
         self.grouper_query_dict: Dict[str, Any] = grouper_query_dict
-        self.grouper_members: set = grouper_query_dict['members']
+        self.grouper_members: set = grouper_members
         self.batch_size: int = batch_size
         self.batch_timeout: int = batch_timeout
         self.batch_delay: int = batch_delay
         self.sync_max: int = sync_max
 
-        self.drops = self._drops()
-        self.adds = self._adds()
-        self.common = self._common()
+        # Resolved once so batches do not repeat the lookups
+        self.members_url: str = grouper_query_dict['grouper_members_url']
+
+        # Opened by synchronize() and closed once it finishes
+        self.session: Optional[requests.Session] = None
+        self._send: Dict[str, Callable[..., requests.Response]] = {}
+
+        # Subset and disjoint checks stop at the first counterexample, so
+        # they are cheap when they fail and save two set operations when
+        # they hold (e.g., for a group that is already in sync)
+        if ldap_members <= grouper_members:
+            self.drops = self._drops()
+            self.adds = set()
+            self.common = ldap_members.copy()
+        elif grouper_members <= ldap_members:
+            self.drops = set()
+            self.adds = self._adds()
+            self.common = grouper_members.copy()
+        elif ldap_members.isdisjoint(grouper_members):
+            self.drops = grouper_members.copy()
+            self.adds = ldap_members.copy()
+            self.common = set()
+        else:
+            self.drops = self._drops()
+            self.adds = self._adds()
+            self.common = self._common()
 
         self.log.debug('returning')
         return
 
+    # Member IDs are UA ID strings (e.g., 'T123456789'), so these use
+    # hash-based set operations. Sorted-array merges (e.g., numpy
+    # intersect1d/setdiff1d) would need an O(n log n) string sort first.
+    # Results are not memoized across Delta objects by operand id():
+    # callers pass mutable sets, and ids are reused once a set is freed
     def _common(self) -> set:
         common = self.ldap_members & self.grouper_members
 
@@ -85,10 +255,197 @@ class Delta:
         self.log.debug('finished drops')
         return drops
 
+    def _send_batch(self, action: str, batch: List[str],
+                    limit: InflightLimit) \
+            -> Tuple[Optional[Dict[str, Any]], float]:
+        """
+        Send a single batch of drops or adds to Grouper.
+
+        If Grouper throttles the batch (see ``THROTTLE_CODES``), ``limit``
+        is reduced and the batch is resent, once the reduced limit allows
+        it, after the Retry-After delay or an exponential backoff. This
+        is tried up to ``MAX_THROTTLE_RETRIES`` times
+
+        :param action: Either 'drop' or 'add'
+        :param batch: Member IDs to drop or add
+        :param limit: Limit on the number of batches in flight
+
+        :return: JSON response from Grouper, or ``None`` if the batch was
+                 still throttled after all retries, and the batch time in
+                 seconds
+        """
+        _, request_key, _, _ = BATCH_ACTIONS[action]
+        send = self._send[action]
+
+        data = batch_payload(request_key, batch)
+
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            with limit as epoch:
+                start_t = time.monotonic()
+                rsp = send(self.members_url, data=data, timeout=self.batch_timeout)
+                batch_t = time.monotonic() - start_t
+
+            if not limit.record(rsp.status_code, epoch):
+                return rsp.json(), batch_t
+
+            if attempt == MAX_THROTTLE_RETRIES:
+                break
+
+            retry_after = rsp.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                wait_t = float(retry_after)
+            else:
+                wait_t = THROTTLE_BACKOFF * 2 ** attempt
+
+            reduced = f", batches in flight reduced to {limit.limit}" \
+                if limit.max_inflight > 1 else ""
+            self.log.warning(f"Grouper throttled batch {action} " +
+                             f"(status code = {rsp.status_code}), " +
+                             f"retrying in {wait_t} seconds{reduced}")
+            time.sleep(wait_t)
+
+        return None, batch_t
+
+    def _log_batch(self, action: str, n_batch: int, batch: List[str],
+                   rsp_j: Optional[Dict[str, Any]], batch_t: float) -> None:
+        """
+        Log the outcome of a batch sent with :meth:`_send_batch`
+
+        :param action: Either 'drop' or 'add'
+        :param n_batch: Batch number
+        :param batch: Member IDs in the batch
+        :param rsp_j: JSON response from Grouper. ``None`` if the batch
+               was throttled after all retries
+        :param batch_t: Batch time in seconds
+        """
+        _, _, result_key, past_tense = BATCH_ACTIONS[action]
+
+        if rsp_j is None:
+            self.log.warning(f"problem running batch {action}, Grouper " +
+                             f"throttled after {MAX_THROTTLE_RETRIES} retries")
+            return
+
+        result_code = rsp_j[result_key]['resultMetadata']['resultCode']
+        if result_code != 'SUCCESS':
+            self.log.warning(f'problem running batch {action}, result code = %s',
+                             result_code)
+        else:
+            self.log.info(f"{past_tense} batch {n_batch}, " +
+                          f"{len(batch)} entries, " +
+                          f"{batch_t} seconds")
+
+    def _open_session(self) -> None:
+        """
+        Open ``self.session`` with the Grouper credentials and a pooled,
+        retrying adapter, and bind the request method for each action
+        """
+        self.session = requests.Session()
+        self.session.auth = (self.grouper_query_dict['grouper_user'],
+                             self.grouper_query_dict['grouper_password'])
+        self.session.headers.update({'Content-type': 'text/x-json'})
+        # Only transient gateway errors are retried here. Grouper reports
+        # its own failures (e.g., PROBLEM_DELETING_MEMBERS) as HTTP 500,
+        # which would fail again, and throttling (THROTTLE_CODES) is left
+        # to _send_batch so that InflightLimit sees it before any retry
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=MAX_WORKERS,
+                              max_retries=Retry(total=5, backoff_factor=0.3,
+                                                status_forcelist=[502, 504],
+                                                allowed_methods=['PUT', 'POST'],
+                                                respect_retry_after_header=True,
+                                                raise_on_status=False))
+        self.session.mount('https://', adapter)
+
+        self._send = {action: getattr(self.session, method)
+                      for action, (method, _, _, _) in BATCH_ACTIONS.items()}
+
+    def _close_session(self) -> None:
+        """
+        Close ``self.session`` and release its pooled connections
+        """
+        self.session.close()
+        self.session = None
+        self._send = {}
+
+    def _batches(self, members: set) -> Iterator[List[str]]:
+        """
+        Split members into batches of at most ``batch_size``
+
+        :param members: Member IDs to drop or add
+
+        :return: Iterator over batches
+        """
+        it = iter(members)
+        batch = list(islice(it, self.batch_size))
+        while batch:
+            yield batch
+            batch = list(islice(it, self.batch_size))
+
+    def _pairs(self) -> Iterator[List[Tuple[str, int, List[str]]]]:
+        """
+        Pair drop and add batches with the same batch number
+
+        :return: Iterator over lists of (action, batch number, batch)
+        """
+        for n_batch, (drop_batch, add_batch) in \
+                enumerate(zip_longest(self._batches(self.drops),
+                                      self._batches(self.adds)), 1):
+            yield [(action, n_batch, batch) for action, batch in
+                   [('drop', drop_batch), ('add', add_batch)]
+                   if batch is not None]
+
+    def _process_batches(self) -> None:
+        """
+        Send all drop and add batches to Grouper.
+
+        Drop and add batches with the same batch number are paired and
+        sent back-to-back over the same pooled ``self.session``. Without a
+        batch delay, batches are sent concurrently using up to
+        ``MAX_WORKERS`` threads. Only about that many batches are read
+        ahead, and the number in flight is bounded by an
+        :class:`InflightLimit` that backs off when Grouper throttles.
+        Otherwise, pairs are sent sequentially with a pause between each,
+        but not after the last one
+        """
+        n_drop_batches = ceil(len(self.drops) / self.batch_size)
+        n_add_batches = ceil(len(self.adds) / self.batch_size)
+        n_pairs = max(n_drop_batches, n_add_batches)
+        n_requests = n_drop_batches + n_add_batches
+
+        if self.batch_delay == 0 and n_requests > 1:
+            max_inflight = min(MAX_WORKERS, n_requests)
+            limit = InflightLimit(max_inflight)
+            jobs = (job for pair in self._pairs() for job in pair)
+            with ThreadPoolExecutor(max_workers=max_inflight) as ex:
+                # Only keep max_inflight batches pending, refilling as each
+                # completes, so batches are not all read up front
+                futures = {}
+                for action, n_batch, batch in islice(jobs, max_inflight):
+                    future = ex.submit(self._send_batch, action, batch, limit)
+                    futures[future] = (action, n_batch, batch)
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._log_batch(*futures.pop(future), *future.result())
+                        for action, n_batch, batch in islice(jobs, 1):
+                            future = ex.submit(self._send_batch, action, batch, limit)
+                            futures[future] = (action, n_batch, batch)
+        else:
+            limit = InflightLimit(1)
+            for n_pair, pair in enumerate(self._pairs(), 1):
+                for action, n_batch, batch in pair:
+                    self._log_batch(action, n_batch, batch,
+                                    *self._send_batch(action, batch, limit))
+
+                # No need to wait after the final pair
+                if self.batch_delay > 0 and n_pair < n_pairs:
+                    self.log.info(f"pausing for {self.batch_delay} seconds")
+                    time.sleep(self.batch_delay)
+
     def synchronize(self) -> None:
         self.log.debug('entered')
 
-        total_delta = len(list(self.adds)) + len(list(self.drops))
+        total_delta = len(self.adds) + len(self.drops)
         if total_delta > self.sync_max:
             self.log.warning(f"total delta ({total_delta}) exceeds maximum " +
                              f"sync limit ({self.sync_max}), will not synchronize")
@@ -101,77 +458,12 @@ class Delta:
                       f"batch timeout = {self.batch_timeout} seconds, " +
                       f"batch delay = {self.batch_delay} seconds")
 
-        self.log.info('processing drops:')
-        n_batches = 0
-        list_of_drops = list(self.drops)
-        for batch in [list_of_drops[i:i + self.batch_size] for
-                      i in range(0, len(list_of_drops), self.batch_size)]:
-            n_batches += 1
-
-            data = dict()
-            data['WsRestDeleteMemberRequest'] = {
-                'replaceAllExisting': 'F',
-                'subjectLookups': [{'subjectId': entry} for entry in batch]
-            }
-
-            start_t = datetime.datetime.now()
-            rsp = requests.post(self.grouper_query_dict['grouper_members_url'],
-                                auth=(self.grouper_query_dict['grouper_user'],
-                                      self.grouper_query_dict['grouper_password']),
-                                data=json.dumps(data),
-                                headers={'Content-type': 'text/x-json'},
-                                timeout=self.batch_timeout)
-            end_t = datetime.datetime.now()
-            batch_t = (end_t - start_t).total_seconds()
-
-            rsp_j = rsp.json()
-            if rsp_j['WsDeleteMemberResults']['resultMetadata']['resultCode'] not in 'SUCCESS':
-                self.log.warning('problem running batch delete, result code = %s',
-                                 rsp_j['WsDeleteMemberResults']['resultMetadata']['resultCode'])
-            else:
-                self.log.info(f"dropped batch {n_batches}, " +
-                              f"{len(batch)} entries, " +
-                              f"{batch_t} seconds")
-
-            if self.batch_delay > 0:
-                self.log.info(f"pausing for {self.batch_delay} seconds")
-                time.sleep(self.batch_delay)
-
-        self.log.info('processing adds:')
-        n_batches = 0
-        list_of_adds = list(self.adds)
-        for batch in [list_of_adds[i:i + self.batch_size] for
-                      i in range(0, len(list_of_adds), self.batch_size)]:
-            n_batches += 1
-
-            data = dict()
-            data['WsRestAddMemberRequest'] = {
-                'replaceAllExisting': 'F',
-                'subjectLookups': [{'subjectId': entry} for entry in batch]
-            }
-
-            start_t = datetime.datetime.now()
-            rsp = requests.put(self.grouper_query_dict['grouper_members_url'],
-                               auth=(self.grouper_query_dict['grouper_user'],
-                                     self.grouper_query_dict['grouper_password']),
-                               data=json.dumps(data),
-                               headers={'Content-type': 'text/x-json'},
-                               timeout=self.batch_timeout)
-            end_t = datetime.datetime.now()
-            batch_t = (end_t - start_t).total_seconds()
-
-            rsp_j = rsp.json()
-            if rsp_j['WsAddMemberResults']['resultMetadata']['resultCode'] not in 'SUCCESS':
-                self.log.warning('problem running batch add, result code = %s',
-                                 rsp_j['WsAddMemberResults']['resultMetadata']['resultCode'])
-            else:
-                self.log.info(f"added batch {n_batches}, " +
-                              f"{len(batch)} entries, " +
-                              f"{batch_t} seconds")
-
-            if self.batch_delay > 0:
-                self.log.info(f"pausing for {self.batch_delay} seconds")
-                time.sleep(self.batch_delay)
+        self.log.info('processing drops and adds:')
+        self._open_session()
+        try:
+            self._process_batches()
+        finally:
+            self._close_session()
 
         self.log.debug('finished synchronize')
         return
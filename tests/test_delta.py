@@ -0,0 +1,400 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import threading
+
+import pytest
+import requests
+
+from requiam.delta import Delta, InflightLimit, batch_payload, \
+    MAX_THROTTLE_RETRIES, MAX_WORKERS, THROTTLE_BACKOFF
+
+ldap_members = {'T000000001', 'T000000002', 'T000000003'}
+grouper_members = {'T000000002', 'T000000003', 'T000000004'}
+
+delta_dict = {'batch_size': 2, 'batch_timeout': 10,
+              'batch_delay': 0, 'sync_max': 100}
+
+
+def grouper_query_dict(members):
+    return {'members': members,
+            'grouper_user': 'user',
+            'grouper_password': 'password',
+            'grouper_members_url': 'https://grouper.test/members',
+            'grouper_group': 'test'}
+
+
+class FakeResponse:
+    def __init__(self, method, status_code=200):
+        self.status_code = status_code
+        self.headers = {}
+        self.result_key = 'WsDeleteMemberResults' if method == 'POST' \
+            else 'WsAddMemberResults'
+
+    def json(self):
+        return {self.result_key: {'resultMetadata': {'resultCode': 'SUCCESS'}}}
+
+
+@pytest.fixture
+def grouper_requests(monkeypatch):
+    """Record Grouper requests and answer them without any network access"""
+    calls = []
+    closed = []
+    statuses = []
+
+    def request(session, method, url, data=None, **kwargs):
+        calls.append((method, url, json.loads(data)))
+        return FakeResponse(method, statuses.pop(0) if statuses else 200)
+
+    monkeypatch.setattr(requests.Session, 'request', request)
+    monkeypatch.setattr(requests.Session, 'close',
+                        lambda session: closed.append(session))
+    return {'calls': calls, 'closed': closed, 'statuses': statuses}
+
+
+def test_Delta():
+
+    d = Delta(ldap_members, grouper_query_dict(grouper_members), **delta_dict)
+
+    assert d.adds == {'T000000001'}
+    assert d.drops == {'T000000004'}
+    assert d.common == {'T000000002', 'T000000003'}
+
+
+def test_Delta_subsets():
+
+    # LDAP is a subset of Grouper: drops only
+    d = Delta({'T000000002'}, grouper_query_dict(grouper_members), **delta_dict)
+    assert d.adds == set()
+    assert d.drops == {'T000000003', 'T000000004'}
+    assert d.common == {'T000000002'}
+
+    # Grouper is a subset of LDAP: adds only
+    d = Delta(ldap_members, grouper_query_dict({'T000000003'}), **delta_dict)
+    assert d.adds == {'T000000001', 'T000000002'}
+    assert d.drops == set()
+    assert d.common == {'T000000003'}
+
+    # Disjoint
+    d = Delta(ldap_members, grouper_query_dict({'T000000004'}), **delta_dict)
+    assert d.adds == ldap_members
+    assert d.drops == {'T000000004'}
+    assert d.common == set()
+
+
+def test_InflightLimit():
+
+    limit = InflightLimit(4, grow_every=2)
+    assert limit.limit == 4
+
+    # Throttling halves the limit
+    with limit as epoch:
+        assert limit._inflight == 1
+    assert limit._inflight == 0
+    assert limit.record(503, epoch)
+    assert limit.limit == 2
+
+    for status_code in [429, 503]:
+        with limit as epoch:
+            pass
+        assert limit.record(status_code, epoch)
+    assert limit.limit == 1
+
+    # Successes slowly raise it back, up to the maximum
+    for _ in range(10):
+        with limit as epoch:
+            pass
+        assert not limit.record(200, epoch)
+    assert limit.limit == 4
+
+
+def test_InflightLimit_concurrent():
+
+    limit = InflightLimit(8)
+
+    # Batches sent together and throttled together halve the limit once
+    epochs = [limit.__enter__() for _ in range(8)]
+    for epoch in epochs:
+        limit.__exit__(None, None, None)
+        assert limit.record(503, epoch)
+    assert limit.limit == 4
+
+    # A batch sent after the decrease can halve it again
+    with limit as epoch:
+        pass
+    assert limit.record(503, epoch)
+    assert limit.limit == 2
+
+
+def test_Delta_list_members():
+
+    d = Delta(sorted(ldap_members),
+              grouper_query_dict(sorted(grouper_members)), **delta_dict)
+
+    assert isinstance(d.ldap_members, frozenset)
+    assert isinstance(d.grouper_members, frozenset)
+    assert d.adds == {'T000000001'}
+    assert d.drops == {'T000000004'}
+
+
+def test_batch_payload():
+
+    # Member IDs needing escaping, and non-str IDs, encode as json.dumps would
+    batch = sorted(ldap_members) + ['T"quoted"', 'T\u00e9', 123456789]
+    for request_key in ['WsRestDeleteMemberRequest', 'WsRestAddMemberRequest']:
+        payload = json.loads(batch_payload(request_key, batch))
+        assert payload == {
+            request_key: {
+                'replaceAllExisting': 'F',
+                'subjectLookups': [{'subjectId': entry} for entry in batch]
+            }
+        }
+
+
+def test_Delta_session(grouper_requests):
+
+    # No session is opened unless synchronizing
+    d = Delta(ldap_members, grouper_query_dict(grouper_members), **delta_dict)
+    assert d.session is None
+
+    # Nothing sent and no session opened when over sync_max
+    d = Delta(ldap_members, grouper_query_dict(grouper_members),
+              **{**delta_dict, 'sync_max': 1})
+    d.synchronize()
+    assert d.session is None
+    assert grouper_requests['calls'] == []
+    assert grouper_requests['closed'] == []
+
+    # Session is closed once synchronize finishes
+    d = Delta(ldap_members, grouper_query_dict(grouper_members), **delta_dict)
+    d.synchronize()
+    assert d.session is None
+    assert len(grouper_requests['calls']) == 2
+    assert len(grouper_requests['closed']) == 1
+
+
+@pytest.mark.parametrize('batch_delay', [0, 1])
+def test_Delta_synchronize(grouper_requests, monkeypatch, batch_delay):
+
+    monkeypatch.setattr('requiam.delta.time.sleep', lambda seconds: None)
+    executors = []
+    monkeypatch.setattr('requiam.delta.ThreadPoolExecutor',
+                        lambda **kwargs: executors.append(kwargs) or
+                        ThreadPoolExecutor(**kwargs))
+
+    drops = {f'T10000000{i}' for i in range(5)}
+    adds = {f'T20000000{i}' for i in range(3)}
+    d = Delta(ldap_members | adds,
+              grouper_query_dict(grouper_members | drops),
+              **{**delta_dict, 'batch_delay': batch_delay})
+    d.synchronize()
+
+    # Batches are only sent concurrently without a batch delay
+    assert executors == ([{'max_workers': 5}] if batch_delay == 0 else [])
+
+    calls = grouper_requests['calls']
+    assert len(calls) == 3 + 2
+    assert all(url == 'https://grouper.test/members' for _, url, _ in calls)
+
+    sent = {'POST': [], 'PUT': []}
+    for method, _, payload in calls:
+        request_key = 'WsRestDeleteMemberRequest' if method == 'POST' \
+            else 'WsRestAddMemberRequest'
+        lookups = payload[request_key]['subjectLookups']
+        assert payload[request_key]['replaceAllExisting'] == 'F'
+        assert 1 <= len(lookups) <= d.batch_size
+        sent[method] += [lookup['subjectId'] for lookup in lookups]
+
+    # Every member is sent exactly once with the right method
+    assert sorted(sent['POST']) == sorted(d.drops)
+    assert sorted(sent['PUT']) == sorted(d.adds)
+
+
+def test_Delta_synchronize_single_batch(grouper_requests, monkeypatch):
+
+    # A single batch is sent without a thread pool
+    def no_executor(**kwargs):
+        raise AssertionError('ThreadPoolExecutor should not be used')
+
+    monkeypatch.setattr('requiam.delta.ThreadPoolExecutor', no_executor)
+
+    d = Delta(ldap_members, grouper_query_dict(ldap_members | {'T000000004'}),
+              **delta_dict)
+    d.synchronize()
+
+    assert grouper_requests['calls'] == [
+        ('POST', 'https://grouper.test/members',
+         {'WsRestDeleteMemberRequest': {
+             'replaceAllExisting': 'F',
+             'subjectLookups': [{'subjectId': 'T000000004'}]}})
+    ]
+
+
+def test_Delta_synchronize_pairs(grouper_requests, monkeypatch):
+
+    calls = grouper_requests['calls']
+    monkeypatch.setattr('requiam.delta.time.sleep',
+                        lambda seconds: calls.append(('sleep', seconds, None)))
+
+    # 3 drop batches and 2 add batches make 3 pairs
+    drops = {f'T10000000{i}' for i in range(5)}
+    adds = {f'T20000000{i}' for i in range(3)}
+    d = Delta(ldap_members | adds,
+              grouper_query_dict(grouper_members | drops),
+              **{**delta_dict, 'batch_delay': 5})
+    d.synchronize()
+
+    # Drop and add batches alternate, pausing between pairs but not
+    # after the last one
+    assert [call[0] for call in calls] == \
+        ['POST', 'PUT', 'sleep', 'POST', 'PUT', 'sleep', 'POST']
+    assert [call[1] for call in calls if call[0] == 'sleep'] == [5, 5]
+
+
+def test_Delta_synchronize_read_ahead(grouper_requests, monkeypatch):
+
+    drops = {f'T1000000{i:02d}' for i in range(40)}
+    adds = {f'T2000000{i:02d}' for i in range(40)}
+    d = Delta(adds, grouper_query_dict(drops), **delta_dict)
+
+    # Track how many batches have been read but not yet logged
+    counts = {'read': 0, 'logged': 0, 'max_pending': 0}
+    batches = d._batches
+    log_batch = d._log_batch
+
+    def counting_batches(members):
+        for batch in batches(members):
+            counts['read'] += 1
+            counts['max_pending'] = max(counts['max_pending'],
+                                        counts['read'] - counts['logged'])
+            yield batch
+
+    def counting_log_batch(*args):
+        counts['logged'] += 1
+        log_batch(*args)
+
+    monkeypatch.setattr(d, '_batches', counting_batches)
+    monkeypatch.setattr(d, '_log_batch', counting_log_batch)
+    d.synchronize()
+
+    assert counts['logged'] == 40
+    assert len(grouper_requests['calls']) == 40
+
+    # zip_longest reads the add batch of a pair along with its drop batch
+    assert counts['max_pending'] <= MAX_WORKERS + 1
+
+
+def test_Delta_throttled_batch(grouper_requests, monkeypatch):
+
+    sleeps = []
+    monkeypatch.setattr('requiam.delta.time.sleep', sleeps.append)
+
+    d = Delta(ldap_members, grouper_query_dict(grouper_members), **delta_dict)
+    d._open_session()
+
+    # Throttled once, then accepted: the limit halves and the batch is resent
+    grouper_requests['statuses'].extend([503, 200])
+    limit = InflightLimit(4)
+    rsp_j, _ = d._send_batch('drop', ['T000000004'], limit)
+
+    assert limit.limit == 2
+    assert rsp_j['WsDeleteMemberResults']['resultMetadata']['resultCode'] == 'SUCCESS'
+    calls = grouper_requests['calls']
+    assert len(calls) == 2
+    assert calls[0] == calls[1]
+    assert sleeps == [THROTTLE_BACKOFF]
+
+    # Still throttled after all retries: no response is parsed
+    calls.clear()
+    grouper_requests['statuses'].extend([429] * (MAX_THROTTLE_RETRIES + 1))
+    rsp_j, _ = d._send_batch('add', ['T000000001'], limit)
+
+    assert rsp_j is None
+    assert limit.limit == 1
+    assert len(calls) == MAX_THROTTLE_RETRIES + 1
+    d._close_session()
+
+
+def test_Delta_synchronize_throttled(grouper_requests, monkeypatch, caplog):
+
+    monkeypatch.setattr('requiam.delta.time.sleep', lambda seconds: None)
+
+    log = logging.getLogger('test_delta')
+    d = Delta(ldap_members, grouper_query_dict(grouper_members),
+              **{**delta_dict, 'batch_delay': 1}, log=log)
+
+    # A throttled batch is resent and the sync carries on with the rest
+    grouper_requests['statuses'].append(503)
+    with caplog.at_level(logging.INFO, logger='test_delta'):
+        d.synchronize()
+
+    methods = [method for method, _, _ in grouper_requests['calls']]
+    assert methods == ['POST', 'POST', 'PUT']
+    assert 'throttled' in caplog.text
+    assert 'dropped batch 1' in caplog.text
+    assert 'added batch 1' in caplog.text
+
+    # Nothing to reduce when sending one batch at a time
+    assert 'batches in flight' not in caplog.text
+
+
+def test_Delta_synchronize_throttled_concurrent(monkeypatch):
+
+    monkeypatch.setattr('requiam.delta.time.sleep', lambda seconds: None)
+
+    # The first MAX_WORKERS batches are in flight together and all throttled
+    lock = threading.Lock()
+    barrier = threading.Barrier(MAX_WORKERS, timeout=10)
+    calls = []
+
+    def request(session, method, url, data=None, **kwargs):
+        with lock:
+            calls.append(method)
+            first_wave = len(calls) <= MAX_WORKERS
+        if first_wave:
+            barrier.wait()
+            return FakeResponse(method, 503)
+        return FakeResponse(method)
+
+    monkeypatch.setattr(requests.Session, 'request', request)
+
+    limits = []
+
+    class RecordingLimit(InflightLimit):
+        def record(self, status_code, epoch):
+            throttled = super().record(status_code, epoch)
+            limits.append(self.limit)
+            return throttled
+
+    monkeypatch.setattr('requiam.delta.InflightLimit', RecordingLimit)
+
+    drops = {f'T1000000{i:02d}' for i in range(2 * MAX_WORKERS)}
+    adds = {f'T2000000{i:02d}' for i in range(2 * MAX_WORKERS)}
+    d = Delta(adds, grouper_query_dict(drops), **delta_dict)
+    d.synchronize()
+
+    # One congestion event halves the limit once, and throttled batches
+    # are resent
+    assert min(limits) == MAX_WORKERS // 2
+    assert len(calls) == 2 * MAX_WORKERS + MAX_WORKERS
+
+
+def test_Delta_session_retries():
+
+    d = Delta(ldap_members, grouper_query_dict(grouper_members), **delta_dict)
+    d._open_session()
+    retry = d.session.get_adapter('https://grouper.test/members').max_retries
+    d._close_session()
+
+    assert retry.total == 5
+    assert not retry.raise_on_status
+    assert retry.respect_retry_after_header
+
+    # Transient gateway errors are retried for both adds and drops
+    for method in ['POST', 'PUT']:
+        assert retry.is_retry(method, 502)
+        assert retry.is_retry(method, 504)
+
+        # Grouper failures are reported, and throttling is left to _send_batch
+        for status_code in [500, 429, 503]:
+            assert not retry.is_retry(method, status_code)